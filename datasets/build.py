@@ -201,6 +201,8 @@ def _test_loader_from_config(cfg, dataset_name, mapper=None):
         "num_workers": cfg["DATALOADER"]["NUM_WORKERS"],
         "sampler": InferenceSampler(len(dataset)),
         "batch_size": batch_size,
+        "pin_memory": cfg["DATALOADER"].get("PIN_MEMORY", False),
+        "persistent_workers": cfg["DATALOADER"].get("PERSISTENT_WORKERS", False),
     }
 
 
@@ -213,6 +215,8 @@ def build_detection_test_loader(
     batch_size: int = 1,
     num_workers: int = 0,
     collate_fn: Optional[Callable[[List[Any]], Any]] = None,
+    pin_memory: bool = False,
+    persistent_workers: bool = False,
 ) -> torchdata.DataLoader:
     """
     Similar to `build_detection_train_loader`, with default batch size = 1,
@@ -236,6 +240,11 @@ def build_detection_test_loader(
         num_workers: number of parallel data loading workers
         collate_fn: same as the argument of `torch.utils.data.DataLoader`.
             Defaults to do no collation and return a list of data.
+        pin_memory: copy the tensors of each batch into page-locked memory in the main
+            process, so that ``.to(device, non_blocking=True)`` is asynchronous. The
+            mappers run in worker processes and must not pin memory themselves.
+        persistent_workers: keep the workers (and any state of the mapper, e.g. its
+            caches) alive between passes over the dataset. Ignored if ``num_workers`` is 0.
 
     Returns:
         DataLoader: a torch DataLoader, that loads the given detection
@@ -267,6 +276,8 @@ def build_detection_test_loader(
         drop_last=False,
         num_workers=num_workers,
         collate_fn=trivial_batch_collator if collate_fn is None else collate_fn,
+        pin_memory=pin_memory,
+        persistent_workers=persistent_workers and num_workers > 0,
     )
 
 
@@ -1,6 +1,8 @@
 # Copyright (c) Facebook, Inc. and its affiliates.
-import copy
+import io
+import itertools
 import logging
+from collections import OrderedDict
 import numpy as np
 from typing import List, Optional, Union
 import torch
@@ -10,18 +12,103 @@ from detectron2.config import configurable
 from detectron2.data import detection_utils as utils
 from detectron2.data import transforms as T
 from detectron2.structures import BitMasks, Instances, Boxes
+from detectron2.utils.file_io import PathManager
+from PIL import Image
 from pycocotools import mask
 import os
 import random
 from tqdm import tqdm
 # import lvis
 
+try:
+    # optional, decodes JPEG files a few times faster than PIL
+    from turbojpeg import TurboJPEG, TJPF_BGR, TJPF_RGB
+except ImportError:
+    TurboJPEG = None
+
+# https://www.exif.org/Exif2-2.PDF, page 20
+_EXIF_ORIENT = 274
+
 """
 This file contains the default mapping that's applied to "dataset dicts".
 """
 
 __all__ = ["LVISInferenceMapperWithGT"]
 
+
+def _or_reduce_polygons(m, offsets):
+    """
+    OR the (H, W, P) polygon maps of each instance, whose first polygon index is given
+    by ``offsets``, into one (H, W) map per instance. ``decode`` returns Fortran-ordered
+    arrays, so every instance slice is one contiguous block.
+    """
+    ends = list(offsets[1:]) + [m.shape[2]]
+    return [
+        m[:, :, start] if end - start == 1
+        else np.bitwise_or.reduce(m[:, :, start:end], axis=2)
+        for start, end in zip(offsets, ends)
+    ]
+
+
+def _flatten_polygons(instances):
+    """
+    Flatten the nested per-instance polygon lists of an image.
+
+    Args:
+        instances (list[list[list[float]]]): polygons of each instance.
+
+    Returns:
+        polygons (list[list[float]]): all polygons of the image.
+        offsets (list[int]): index of the first polygon of each instance in ``polygons``.
+    """
+    polygons = list(itertools.chain.from_iterable(instances))
+    offsets = list(itertools.accumulate([len(inst) for inst in instances[:-1]], initial=0))
+    return polygons, offsets
+
+
+def _decode_instance_masks(polygons, offsets, height, width):
+    """
+    Decode the polygons of all instances of an image with a single pycocotools call.
+
+    Args:
+        polygons, offsets: see :func:`_flatten_polygons`.
+        height, width (int): size of the original image.
+
+    Returns:
+        list[np.ndarray]: N uint8 arrays of shape (H, W) with values in {0, 1}, one binary
+            map per instance. Instances with a single polygon are views into the decoded
+            maps, so the arrays must not be modified in place.
+    """
+    rles = mask.frPyObjects(polygons, height, width)
+    m = mask.decode(rles)  # (H, W, total number of polygons)
+    # sometimes there are multiple binary map (corresponding to multiple segs);
+    # decode() gives 0/1 maps so OR-ing them keeps the result binary and in uint8
+    return _or_reduce_polygons(m, offsets)
+
+
+def _bboxes_from_masks(masks):
+    """
+    Same as :meth:`BitMasks.get_bounding_boxes`, but with a few batched reductions
+    instead of a Python loop over the masks.
+
+    Args:
+        masks (Tensor): bool tensor of shape (N, H, W).
+
+    Returns:
+        Boxes: tight XYXY boxes, all zeros for empty masks.
+    """
+    x_any = masks.any(dim=1).float()  # (N, W)
+    y_any = masks.any(dim=2).float()  # (N, H)
+    # argmax returns the first maximal index, i.e. the first non-empty column / row
+    x0 = x_any.argmax(dim=1)
+    y0 = y_any.argmax(dim=1)
+    x1 = x_any.shape[1] - x_any.flip(1).argmax(dim=1)
+    y1 = y_any.shape[1] - y_any.flip(1).argmax(dim=1)
+    boxes = torch.stack([x0, y0, x1, y1], dim=1).float()
+    non_empty = (x_any.amax(dim=1) > 0) & (y_any.amax(dim=1) > 0)
+    return Boxes(boxes * non_empty[:, None])
+
+
 class LVISInferenceMapperWithGT:
     """
     A callable which takes a dataset dict in Detectron2 Dataset format,
@@ -52,6 +139,10 @@ class LVISInferenceMapperWithGT:
             keypoint_hflip_indices: Optional[np.ndarray] = None,
             precomputed_proposal_topk: Optional[int] = None,
             recompute_boxes: bool = False,
+            mask_cache_size: int = 0,
+            mask_dir: Optional[str] = None,
+            pack_masks: bool = False,
+            need_dense_masks: bool = True,
     ):
         """
         NOTE: this interface is experimental.
@@ -69,6 +160,20 @@ class LVISInferenceMapperWithGT:
                 proposals from dataset_dict and keep the top k proposals for each image.
             recompute_boxes: whether to overwrite bounding box annotations
                 by computing tight bounding boxes from instance mask annotations.
+            mask_cache_size: number of images whose decoded (pre-augmentation) instance
+                masks are kept in memory, so that repeated passes over the dataset skip
+                the RLE decoding. The cache is per process, i.e. per dataloader worker.
+                Masks loaded from ``mask_dir`` are not cached. 0 disables it.
+            mask_dir: directory with the masks pre-decoded by
+                :mod:`datasets.prepare_lvis_masks`, one ``{image_id}.npy`` file per image.
+                Images without a file there are decoded from their polygons.
+            pack_masks: whether to store the gt masks bit-packed (8 pixels per byte) as
+                ``gt_masks_packed`` instead of ``gt_masks``, which cuts the data moved
+                between dataloader workers and to the GPU by 8x. The model unpacks them
+                with :func:`dinov.utils.misc.unpack_masks` once they are on device.
+            need_dense_masks: whether the model needs the gt masks. If False, only
+                ``gt_boxes`` are produced, computed from the compressed RLEs without
+                decoding any mask.
         """
         if recompute_boxes:
             assert use_instance_mask, "recompute_boxes requires instance masks"
@@ -82,7 +187,19 @@ class LVISInferenceMapperWithGT:
         self.keypoint_hflip_indices = keypoint_hflip_indices
         self.proposal_topk = precomputed_proposal_topk
         self.recompute_boxes = recompute_boxes
+        self.mask_cache_size = mask_cache_size
+        self.mask_dir = mask_dir
+        self.pack_masks = pack_masks
+        self.need_dense_masks = need_dense_masks
         # fmt: on
+        self._mask_cache = OrderedDict()
+        # resolved once here, instead of a stat() per image in __call__
+        self._mask_files = set()
+        if mask_dir is not None:
+            self._mask_files = {f for f in os.listdir(mask_dir) if f.endswith(".npy")}
+        # created lazily, so that every dataloader worker loads its own libjpeg-turbo handle
+        self._jpeg = None
+        self._use_turbojpeg = TurboJPEG is not None and image_format in ("RGB", "BGR")
         logger = logging.getLogger(__name__)
         mode = "training" if is_train else "inference"
         logger.info(f"[DatasetMapper] Augmentations used in {mode}: {augmentations}")
@@ -109,6 +226,10 @@ class LVISInferenceMapperWithGT:
             "instance_mask_format": cfg.INPUT.MASK_FORMAT,
             "use_keypoint": cfg.MODEL.KEYPOINT_ON,
             "recompute_boxes": recompute_boxes,
+            "mask_cache_size": cfg.INPUT.get("MASK_CACHE_SIZE", 0),
+            "mask_dir": cfg.INPUT.get("PRECOMPUTED_MASK_DIR", None),
+            "pack_masks": cfg.INPUT.get("PACK_GT_MASKS", False),
+            "need_dense_masks": cfg.INPUT.get("DENSE_GT_MASKS", True),
         }
 
         if cfg.MODEL.KEYPOINT_ON:
@@ -151,6 +272,85 @@ class LVISInferenceMapperWithGT:
             instances.gt_boxes = instances.gt_masks.get_bounding_boxes()
         dataset_dict["instances"] = utils.filter_empty_instances(instances)
 
+    def _read_image(self, file_name):
+        """
+        Same as :func:`detection_utils.read_image`, but decodes JPEG files with
+        libjpeg-turbo when PyTurboJPEG and the libturbojpeg library are installed.
+        Images carrying an EXIF orientation or an unreadable EXIF block, or that
+        libjpeg-turbo cannot convert, are still read by :func:`detection_utils.read_image`.
+        """
+        if self._use_turbojpeg and file_name.lower().endswith((".jpg", ".jpeg")):
+            with PathManager.open(file_name, "rb") as f:
+                buf = f.read()
+            try:
+                # only parses the header, the pixels are not decoded by PIL
+                orientation = Image.open(io.BytesIO(buf)).getexif().get(_EXIF_ORIENT, 1)
+            except Exception:  # https://github.com/facebookresearch/detectron2/issues/1885
+                orientation = None
+            if orientation == 1 and self._jpeg is None:
+                try:
+                    self._jpeg = TurboJPEG()
+                except (RuntimeError, OSError):
+                    # PyTurboJPEG imports without libturbojpeg, but cannot load it
+                    self._use_turbojpeg = False
+            if orientation == 1 and self._use_turbojpeg:
+                pixel_format = TJPF_BGR if self.image_format == "BGR" else TJPF_RGB
+                try:
+                    return self._jpeg.decode(buf, pixel_format=pixel_format)
+                except OSError:
+                    pass
+        return utils.read_image(file_name, format=self.image_format)
+
+    def _get_instance_boxes(self, dataset_dict):
+        """
+        Returns the (N, 4) XYXY boxes of the instances in the original image, with the
+        same exclusive max coordinates as :func:`_bboxes_from_masks`.
+        """
+        if "instance_rle" in dataset_dict:
+            rles = dataset_dict["instance_rle"]
+        else:
+            polygons, offsets = _flatten_polygons(dataset_dict['instance'])
+            polygon_rles = mask.frPyObjects(
+                polygons, dataset_dict['height'], dataset_dict['width']
+            )
+            ends = list(offsets[1:]) + [len(polygon_rles)]
+            rles = [mask.merge(polygon_rles[start:end]) for start, end in zip(offsets, ends)]
+        boxes = mask.toBbox(rles)  # XYWH
+        boxes[:, 2:] += boxes[:, :2]
+        return boxes
+
+    def _get_instance_masks(self, dataset_dict):
+        """
+        Returns the N decoded (H, W) instance masks of the original image, going through
+        the LRU cache and the pre-decoded masks when they are enabled. The returned masks
+        must not be modified in place.
+        """
+        image_id = dataset_dict["image_id"]
+        if image_id in self._mask_cache:
+            self._mask_cache.move_to_end(image_id)
+            return self._mask_cache[image_id]
+
+        mask_file = f"{image_id}.npy"
+        if mask_file in self._mask_files:
+            # memory-mapped, the pages are only read when the masks are transformed.
+            # Not cached: every memmap holds a file descriptor open, and the OS page
+            # cache already keeps the data
+            return np.load(os.path.join(self.mask_dir, mask_file), mmap_mode="r")
+        if "instance_rle" in dataset_dict:
+            # polygons already merged into one compressed RLE per instance at registration
+            masks = mask.decode(dataset_dict["instance_rle"]).transpose(2, 0, 1)
+        else:
+            masks = _decode_instance_masks(
+                *_flatten_polygons(dataset_dict['instance']),
+                dataset_dict['height'],
+                dataset_dict['width'],
+            )
+        if self.mask_cache_size > 0:
+            self._mask_cache[image_id] = masks
+            if len(self._mask_cache) > self.mask_cache_size:
+                self._mask_cache.popitem(last=False)
+        return masks
+
     def __call__(self, dataset_dict):
         """
         Args:
@@ -159,9 +359,12 @@ class LVISInferenceMapperWithGT:
         Returns:
             dict: a format that builtin models in detectron2 accept
         """
-        dataset_dict = copy.deepcopy(dataset_dict)  # it will be modified by code below
+        # only new keys are added below and the polygons are never modified in place,
+        # so a shallow copy is enough (deep-copying every polygon is costly)
+        dataset_dict = dict(dataset_dict)
+        assert len(dataset_dict['instance']) > 0
         # USER: Write your own image loading if it's not from a file
-        image = utils.read_image(dataset_dict["file_name"], format=self.image_format)
+        image = self._read_image(dataset_dict["file_name"])
         utils.check_image_size(dataset_dict, image)
 
         sem_seg_gt = None
@@ -175,31 +378,40 @@ class LVISInferenceMapperWithGT:
         # Therefore it's important to use torch.Tensor.
         dataset_dict["image"] = torch.as_tensor(np.ascontiguousarray(image.transpose(2, 0, 1)))
 
-        assert len(dataset_dict['instance']) > 0
-        masks = []
-        classes = []
-        for inst, label in zip(dataset_dict['instance'], dataset_dict['labels']):
-            rle = mask.frPyObjects(inst, dataset_dict['height'], dataset_dict['width'])
-            m = mask.decode(rle)
-            # sometimes there are multiple binary map (corresponding to multiple segs)
-            m = np.sum(m, axis=2)
-            m = m.astype(np.uint8)  # convert to np.uint8
-            masks.append(transforms.apply_segmentation(m[:, :, None])[:, :, 0])
-            classes.append(label)
-
         instances = Instances(image_shape)
-        classes = np.array(classes)
-        instances.gt_classes = torch.tensor(classes, dtype=torch.int64)
-        if len(masks) == 0:
+        labels = dataset_dict['labels']
+        instances.gt_classes = torch.from_numpy(
+            np.fromiter(labels, dtype=np.int64, count=len(labels))
+        )
+        if not self.need_dense_masks:
+            # boxes only: taken from the compressed RLEs, no (H, W) mask is decoded
+            boxes = transforms.apply_box(self._get_instance_boxes(dataset_dict))
+            instances.gt_boxes = Boxes(torch.from_numpy(boxes).float())
+            instances.gt_boxes.clip(image_shape)
+            dataset_dict["instances"] = instances
+            return dataset_dict
+
+        masks = self._get_instance_masks(dataset_dict)
+        # write each transformed mask straight into its own contiguous row of one
+        # (N, H, W) bool buffer, so that neither torch.from_numpy nor BitMasks has to
+        # copy or cast it again
+        mask_buf = np.empty((len(masks), image_shape[0], image_shape[1]), bool)
+        for i, m in enumerate(masks):
+            mask_buf[i] = transforms.apply_segmentation(m[:, :, None])[:, :, 0]
+
+        if len(mask_buf) == 0:
             # Some image does not have annotation (all ignored)
             instances.gt_masks = torch.zeros((0, image_shape[0], image_shape[1]))
             instances.gt_boxes = Boxes(torch.zeros((0, 4)))
         else:
-            masks = BitMasks(
-                torch.stack([torch.from_numpy(np.ascontiguousarray(x.copy())) for x in masks])
-            )
-            instances.gt_masks = masks.tensor
-            instances.gt_boxes = masks.get_bounding_boxes()
+            masks = BitMasks(torch.from_numpy(mask_buf))
+            if self.pack_masks:
+                instances.gt_masks_packed = torch.from_numpy(
+                    np.packbits(mask_buf.reshape(len(mask_buf), -1), axis=1)
+                )
+            else:
+                instances.gt_masks = masks.tensor
+            instances.gt_boxes = _bboxes_from_masks(masks.tensor)
         dataset_dict["instances"] = instances
 
         # ! HARD CODE HERE TO LOAD EMBEDDINGS
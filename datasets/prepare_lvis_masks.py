@@ -0,0 +1,49 @@
+"""
+Pre-decode the instance masks of an LVIS split, so that :class:`LVISInferenceMapperWithGT`
+loads them from disk instead of parsing the polygons of every image again.
+
+Each image gets one ``{image_id}.npy`` file holding its (N, H, W) uint8 masks before
+augmentation, in the order of ``dataset_dict["instance"]``. Usage:
+
+    python -m DINOv.datasets.prepare_lvis_masks --dataset lvis_v1_minival --output-dir OUT
+
+then set ``INPUT.PRECOMPUTED_MASK_DIR`` to ``OUT``. The split is looked up in
+:class:`DatasetCatalog`, so ``DATASET`` and ``DATASET3`` must both be exported for
+:mod:`datasets.registration.register_lvis_eval` to register it. The files are not
+compressed and take several GB per split.
+"""
+import argparse
+import os
+
+import numpy as np
+from tqdm import tqdm
+from detectron2.data import DatasetCatalog
+
+from .dataset_mappers.lvis_dataset_mapper_with_gt import (
+    _decode_instance_masks,
+    _flatten_polygons,
+)
+
+
+def prepare_lvis_masks(dataset_name, output_dir, overwrite=False):
+    os.makedirs(output_dir, exist_ok=True)
+    for dataset_dict in tqdm(DatasetCatalog.get(dataset_name)):
+        mask_file = os.path.join(output_dir, f"{dataset_dict['image_id']}.npy")
+        if os.path.isfile(mask_file) and not overwrite:
+            continue
+        masks = _decode_instance_masks(
+            *_flatten_polygons(dataset_dict['instance']),
+            dataset_dict['height'],
+            dataset_dict['width'],
+        )
+        np.save(mask_file, np.stack(masks))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-decode LVIS instance masks.")
+    parser.add_argument("--dataset", default="lvis_v1_minival", help="registered dataset name")
+    parser.add_argument("--output-dir", required=True)
+    parser.add_argument("--overwrite", action="store_true")
+    args = parser.parse_args()
+
+    prepare_lvis_masks(args.dataset, args.output_dir, overwrite=args.overwrite)
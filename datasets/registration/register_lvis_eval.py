@@ -7,6 +7,7 @@ import logging
 import os
 from detectron2.utils.file_io import PathManager
 from fvcore.common.timer import Timer
+import pycocotools.mask as mask_util
 import json
 
 
@@ -46,7 +47,7 @@ def get_lvis_instances_meta_v1():
     return meta
 
 
-def register_lvis_instances(name, metadata, json_file, image_root):
+def register_lvis_instances(name, metadata, json_file, image_root, merge_rle=False):
     """
     Register a dataset in LVIS's json annotation format for instance detection and segmentation.
 
@@ -55,19 +56,25 @@ def register_lvis_instances(name, metadata, json_file, image_root):
         metadata (dict): extra metadata associated with this dataset. It can be an empty dict.
         json_file (str): path to the json instance annotation file.
         image_root (str or path-like): directory which contains all the images.
+        merge_rle (bool): see :func:`load_lvis_json`.
     """
-    DatasetCatalog.register(name, lambda: load_lvis_json(image_root, json_file, name))
+    DatasetCatalog.register(
+        name, lambda: load_lvis_json(image_root, json_file, name, merge_rle=merge_rle)
+    )
     MetadataCatalog.get(name).set(
         json_file=json_file, image_root=image_root, evaluator_type="lvis", **metadata
     )
 
 
-def load_lvis_json(image_root, annot_json, metadata):
+def load_lvis_json(image_root, annot_json, metadata, merge_rle=False):
     """
     Args:
         image_dir (str): path to the raw dataset. e.g., "~/coco/train2017".
         gt_dir (str): path to the raw annotations. e.g., "~/coco/panoptic_train2017".
         json_file (str): path to the json file. e.g., "~/coco/annotations/panoptic_train2017.json".
+        merge_rle (bool): also store the polygons of every instance merged into a single
+            compressed RLE under "instance_rle", so that mappers decode each instance with
+            one call instead of parsing its polygons in every epoch.
     Returns:
         list[dict]: a list of dicts in Detectron2 standard format. (See
         `Using Custom Datasets </tutorials/datasets.html>`_ )
@@ -103,17 +110,21 @@ def load_lvis_json(image_root, annot_json, metadata):
         if image_id not in imageid2lable:
             cnt_empty += 1
             continue
-        ret.append(
-            {
-                "file_name": image_file,
-                "image_id": image_id,
-                "height": image["height"],
-                "width": image["width"],
-                "instance": imageid2seg[image_id],
-                "box": imageid2box[image_id],
-                "labels": imageid2lable[image_id],
-            }
-        )
+        record = {
+            "file_name": image_file,
+            "image_id": image_id,
+            "height": image["height"],
+            "width": image["width"],
+            "instance": imageid2seg[image_id],
+            "box": imageid2box[image_id],
+            "labels": imageid2lable[image_id],
+        }
+        if merge_rle:
+            record["instance_rle"] = [
+                mask_util.merge(mask_util.frPyObjects(seg, image["height"], image["width"]))
+                for seg in imageid2seg[image_id]
+            ]
+        ret.append(record)
 
     print("Empty annotations: {}".format(cnt_empty))
     assert len(ret), f"No images found in {image_root}!"
@@ -133,10 +144,14 @@ def register_all_lvis(_root_eval, _root_train):
                 get_lvis_instances_meta_v1(),
                 os.path.join(root, json_file) if "://" not in json_file else json_file,
                 os.path.join(root, image_root),
+                merge_rle=_merge_rle and "val" in key,
             )
 
 
 _root_eval = os.getenv("DATASET3", "datasets")
 _root_train = os.getenv("DATASET", "datasets")
+# opt-in, val splits only: merging costs one pass over all polygons at registration
+# and keeps the RLEs in memory next to the polygons, and the train mapper never reads them
+_merge_rle = os.getenv("LVIS_MERGE_RLE", "0") == "1"
 if _root_train != "datasets" and _root_eval != "datasets":
     register_all_lvis(_root_eval, _root_train)
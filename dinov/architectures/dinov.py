@@ -25,6 +25,7 @@ from ..utils import (
     get_iou,
     box_postprocess,
     build_point_grid,
+    unpack_masks,
 )
 from ..backbone import build_backbone, Backbone
 from ..body import build_openseed_head
@@ -651,7 +652,7 @@ class DINOv(nn.Module):
                     segments_info (list[dict]): Describe each segment in `panoptic_seg`.
                         Each dict contains keys "id", "category_id", "isthing".
         """
-        images = [x["image"].to(self.device) for x in batched_inputs]
+        images = [x["image"].to(self.device, non_blocking=True) for x in batched_inputs]
         images = [(x - self.pixel_mean) / self.pixel_std for x in images]
         images = ImageList.from_tensors(images, self.size_divisibility)
 
@@ -795,6 +796,11 @@ class DINOv(nn.Module):
             targets = {}
             if "instances" in batched_inputs[0]:
                 gt_instances = [x["instances"].to(self.device) for x in batched_inputs]
+                for inst in gt_instances:
+                    # masks bit-packed by the dataset mapper are only unpacked on device
+                    if inst.has("gt_masks_packed"):
+                        inst.gt_masks = unpack_masks(inst.gt_masks_packed, *inst.image_size)
+                        inst.remove("gt_masks_packed")
                 targets["content"] = (
                     self.prepare_targets_visual_openset_batch_cross_gpu(
                         gt_instances,
@@ -826,7 +832,7 @@ class DINOv(nn.Module):
         for inference:
         randomly sample some prompts from the pre-processed content prompts as visual examples
         """
-        images = [x["image"].to(self.device) for x in batched_inputs]
+        images = [x["image"].to(self.device, non_blocking=True) for x in batched_inputs]
         images = [(x - self.pixel_mean) / self.pixel_std for x in images]
         images = ImageList.from_tensors(images, self.size_divisibility)
 
@@ -1567,7 +1573,7 @@ class DINOv(nn.Module):
         return new_targets
 
     def prepare_image(self, batched_inputs, key="image"):
-        images = [x["image"].to(self.device) for x in batched_inputs]
+        images = [x["image"].to(self.device, non_blocking=True) for x in batched_inputs]
         images = [(x - self.pixel_mean) / self.pixel_std for x in images]
         images = ImageList.from_tensors(images, self.size_divisibility)
         return images
@@ -1835,7 +1841,7 @@ class DINOv(nn.Module):
         prediction_switch = {"part": False, "whole": False, "seg": True, "det": True}
 
         def prepare_image(batched_inputs, key="image"):
-            images = [x["image"].to(self.device) for x in batched_inputs]
+            images = [x["image"].to(self.device, non_blocking=True) for x in batched_inputs]
             images = [(x - self.pixel_mean) / self.pixel_std for x in images]
             images = ImageList.from_tensors(images, self.size_divisibility)
             return images
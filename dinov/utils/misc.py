@@ -300,6 +300,17 @@ def get_iou(gt_masks, pred_masks, ignore_label=-1):
     return ious
 
 
+def unpack_masks(packed, height, width):
+    """
+    Inverse of ``np.packbits(masks.reshape(n, -1), axis=1)``: turn (n, ceil(h * w / 8))
+    uint8 bit-packed masks back into an (n, h, w) bool tensor, on the device of ``packed``.
+    """
+    n = packed.shape[0]
+    bits = 1 << torch.arange(7, -1, -1, dtype=torch.uint8, device=packed.device)
+    masks = torch.bitwise_and(packed.unsqueeze(-1), bits) != 0
+    return masks.reshape(n, -1)[:, : height * width].reshape(n, height, width)
+
+
 def _max_by_axis(the_list):
     # type: (List[List[int]]) -> List[int]
     maxes = the_list[0]